@@ -1,23 +1,62 @@
 import json
 import os
+import sys
 import ipaddress
 import time
 import traceback
+import itertools
+from contextlib import contextmanager
+from bisect import bisect_right
+import numpy as np
 from z3 import *
 
 # ==========================================
 # [Global Definitions] Z3 Types and Predicates
 # ==========================================
-RouterSort = DeclareSort('Router')
-RTSort = DeclareSort('RT')
-IPSort = IntSort()  # Using IntSort for integer optimization, significantly faster than BitVec
+# Router / RT sorts are EnumSorts over the loaded topology and config, so they and
+# the predicates over them are declared per load by VpnTheory (see below)
 
-Ibgp_Neighbor = Function('Ibgp_Neighbor', RouterSort, RouterSort, BoolSort())
-Has_Import_RT = Function('Has_Import_RT', RouterSort, RTSort, BoolSort())
-Has_Export_RT = Function('Has_Export_RT', RouterSort, RTSort, BoolSort())
+# ACL matching is a bounded 32-bit range problem: QF_BV handles it with cheap
+# unsigned comparisons and avoids LIA branch-and-bound. Set False to benchmark IntSort.
+USE_BITVEC_IP = True
+IPSort = BitVecSort(32) if USE_BITVEC_IP else IntSort()
 
-# Global predicate specifically for Monolithic Mode
-Is_Prefix_Denied_Global = Function('Is_Prefix_Denied_Global', RouterSort, IPSort, BoolSort())
+# Hybrid has no IP theory left (ACL/RT decided in Python), only ground UF terms over
+# the RecFunction definitions. QF_* logics drop those definitions (e.g. QF_UF finds
+# Ibgp_Neighbor(x, x) sat), so UF is the narrowest logic that stays sound.
+HYBRID_LOGIC = "UF"
+
+# Monolithic carries every ACL, so let Z3 split its search across cores. Hybrid
+# queries are trivially small and stay sequential (parallel overhead would dominate).
+# On a single core the parallel mode is pure overhead, so it is off there.
+MONO_PARALLEL = (os.cpu_count() or 1) > 1
+
+# Deny interval sets larger than this are encoded as a balanced comparison tree
+ACL_BST_THRESHOLD = 8
+
+# Per-load suffix for the EnumSort names: Z3 rejects redeclaring an enumeration
+# sort, so each load (e.g. one per config file) gets its own Router_<n> / RT_<n>
+_theory_ids = itertools.count()
+
+
+class VpnTheory:
+    # EnumSorts over one loaded topology / config (distinct by construction: no
+    # Distinct() over routers / RTs needed) and the predicates over them, defined
+    # via RecAddDefinition (closed-world pair membership)
+    def __init__(self, node_ids, rt_strs):
+        n = next(_theory_ids)
+        self.router_sort, router_consts = EnumSort(f'Router_{n}', node_ids)
+        # An enumeration needs at least one value: a config without RTs gets a
+        # sentinel that no router imports or exports
+        rt_names = [f"rt_{s.replace(':', '_')}" for s in rt_strs] or ['rt__none']
+        self.rt_sort, rt_consts = EnumSort(f'RT_{n}', rt_names)
+
+        self.ibgp_neighbor = RecFunction('Ibgp_Neighbor', self.router_sort, self.router_sort, BoolSort())
+        self.has_import_rt = RecFunction('Has_Import_RT', self.router_sort, self.rt_sort, BoolSort())
+        self.has_export_rt = RecFunction('Has_Export_RT', self.router_sort, self.rt_sort, BoolSort())
+
+        self.r_map = dict(zip(node_ids, router_consts))
+        self.rt_z3_map = dict(zip(rt_strs, rt_consts))
 
 
 # ==========================================
@@ -28,34 +67,191 @@ def ip_str_to_int(ip_str):
     return int(ipaddress.IPv4Address(ip_str))
 
 
-def get_ip_interval(prefix_str, mask_len):
-    ip_int = ip_str_to_int(prefix_str)
-    mask_bit = (0xFFFFFFFF << (32 - mask_len)) & 0xFFFFFFFF
+def raise_invalid_acl_rule(raw_prefixes, p_strs, mask_vals):
+    # Error path of parse_acl_rules_batch: its checks run on the whole batch at
+    # once, so replay them per rule to report the first offending prefix
+    for raw_prefix, p_str, mask in zip(raw_prefixes, p_strs, mask_vals):
+        parts = p_str.split('.')
+        if len(parts) != 4 or not all(o.isascii() and o.isdigit() and int(o) <= 255 for o in parts):
+            raise ValueError(f"Invalid ACL prefix: {raw_prefix!r}")
+        try:
+            mask = int(mask)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid ACL mask {mask!r} for prefix {raw_prefix!r}") from None
+        if not 0 <= mask <= 32:
+            raise ValueError(f"Invalid ACL mask length {mask} for prefix {raw_prefix!r}")
+    raise ValueError("Invalid ACL rule")
+
+
+def parse_acl_rules_batch(rule_lists):
+    # Parse every rule of every ACL in one vectorized pass.
+    # Returns one list of (start, end, deny) triples per input rule list.
+    rules = [rule for rules in rule_lists for rule in rules]
+    if not rules: return [[] for _ in rule_lists]
+
+    raw_prefixes = [rule.get('prefix', '0.0.0.0') for rule in rules]
+    splits = [raw_prefix.partition('/') for raw_prefix in raw_prefixes]
+    p_strs = [p_str for p_str, _, _ in splits]
+    mask_vals = [m_str if sep else rule.get('mask', 32) for (_, sep, m_str), rule in zip(splits, rules)]
+    denies = [rule.get('action', 'permit') == 'deny' for rule in rules]
+
+    # Single split of all prefixes. Shape checks run on the batch: 4 octets per rule
+    # (else the reshape misaligns), ASCII digits only (int() would also accept
+    # ' 1', '+1', '1_0'), octets <= 255 and masks in 0..32 (else uint64 wraps)
+    joined = '.'.join(p_strs)
+    octet_strs = joined.split('.')
+    digits = joined.replace('.', '')
+    if len(octet_strs) != 4 * len(rules) or not (digits.isascii() and digits.isdigit()):
+        raise_invalid_acl_rule(raw_prefixes, p_strs, mask_vals)
+    try:
+        # uint64 so that shifts by 32 (mask 0) stay well-defined
+        octets = np.array(octet_strs, dtype=np.uint64).reshape(-1, 4)
+        masks = np.array(mask_vals, dtype=np.int64)
+    except (TypeError, ValueError, OverflowError):  # Empty octet, non-integer mask
+        raise_invalid_acl_rule(raw_prefixes, p_strs, mask_vals)
+    if (octets > 255).any() or ((masks < 0) | (masks > 32)).any():
+        raise_invalid_acl_rule(raw_prefixes, p_strs, mask_vals)
+
+    ip_int = (octets[:, 0] << 24) | (octets[:, 1] << 16) | (octets[:, 2] << 8) | octets[:, 3]
+    host_bits = np.uint64(32) - masks.astype(np.uint64)
+    mask_bit = (np.uint64(0xFFFFFFFF) << host_bits) & np.uint64(0xFFFFFFFF)
     start_ip = ip_int & mask_bit
-    size = 1 << (32 - mask_len)
-    end_ip = start_ip + size - 1
-    return start_ip, end_ip
+    end_ip = start_ip + (np.uint64(1) << host_bits) - np.uint64(1)
+
+    triples = list(zip(start_ip.tolist(), end_ip.tolist(), denies))
+    result, offset = [], 0
+    for rules in rule_lists:
+        result.append(triples[offset:offset + len(rules)])
+        offset += len(rules)
+    return result
+
+
+@contextmanager
+def scoped_z3_params(params):
+    # Set global Z3 parameters for the duration of the block, then restore the
+    # previous values even if the block raises
+    saved = {name: get_param(name) for name in params}
+    try:
+        for name, value in params.items(): set_param(name, value)
+        yield
+    finally:
+        for name, value in saved.items(): set_param(name, value)
+
+
+def declare_ip_var(solver, name):
+    # IP variable of IPSort; IntSort needs explicit 32-bit bounds
+    ip_var = Const(name, IPSort)
+    if not USE_BITVEC_IP: solver.add(ip_var >= 0, ip_var <= 4294967295)
+    return ip_var
+
+
+def ip_in_range(ip_var, start, end):
+    if USE_BITVEC_IP: return And(UGE(ip_var, start), ULE(ip_var, end))
+    return And(ip_var >= start, ip_var <= end)
+
+
+def ip_below(ip_var, bound):
+    if USE_BITVEC_IP: return ULT(ip_var, bound)
+    return ip_var < bound
+
+
+def subtract_intervals(start, end, decided):
+    # Remainders of [start, end] not covered by sorted disjoint `decided` ranges
+    remainders = []
+    cur = start
+    for d_start, d_end in decided:
+        if d_end < cur: continue
+        if d_start > end: break
+        if d_start > cur: remainders.append((cur, d_start - 1))
+        cur = max(cur, d_end + 1)
+        if cur > end: break
+    if cur <= end: remainders.append((cur, end))
+    return remainders
+
+
+def insert_interval(decided, start, end):
+    # Union [start, end] into sorted disjoint `decided` ranges
+    merged = []
+    placed = False
+    for d_start, d_end in decided:
+        if d_end + 1 < start:
+            merged.append((d_start, d_end))
+        elif end + 1 < d_start:
+            if not placed:
+                merged.append((start, end))
+                placed = True
+            merged.append((d_start, d_end))
+        else:
+            start, end = min(start, d_start), max(end, d_end)
+    if not placed: merged.append((start, end))
+    return merged
+
+
+def compute_effective_deny_intervals(triples):
+    # First-match-wins sweep: a deny rule only applies to the part of its range
+    # not already decided by an earlier (permit or deny) rule
+    decided = []
+    deny_intervals = []
+    for start, end, action_deny in triples:
+        if action_deny:
+            deny_intervals.extend(subtract_intervals(start, end, decided))
+        decided = insert_interval(decided, start, end)
+    return deny_intervals
+
+
+def define_pair_predicate(pred, x, y, true_pairs):
+    # pred(x, y) holds exactly for the enumerated (u, v) pairs
+    body = Or(*[And(x == u, y == v) for u, v in true_pairs]) if true_pairs else BoolVal(False)
+    RecAddDefinition(pred, [x, y], body)
+
+
+def merge_intervals(intervals):
+    # Sort by start and merge overlapping / adjacent ranges
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def has_rt_overlap(export_set, import_set, sid, did):
+    # Does some RT exported by sid get imported by did?
+    return bool(export_set.get(sid, set()) & import_set.get(did, set()))
+
 
+class AclIntervalTree:
+    # Static lookup structure over a router's merged (sorted, disjoint) deny intervals.
+    # Lookups for a concrete IP are O(log K) and never touch Z3.
+    def __init__(self, deny_intervals):
+        self.intervals = deny_intervals
+        self.starts = [start for start, _ in deny_intervals]
+        self.ends = [end for _, end in deny_intervals]
 
-def build_acl_logic(ip_var, rules):
-    if not rules: return BoolVal(False)
-    rule = rules[0]
+    def __len__(self):
+        return len(self.intervals)
 
-    # Parse rule prefix and mask
-    raw_prefix = rule.get('prefix', '0.0.0.0')
-    if '/' in raw_prefix:
-        p_str, m_str = raw_prefix.split('/')
-        mask = int(m_str)
-    else:
-        p_str = raw_prefix
-        mask = int(rule.get('mask', 32))
+    def is_denied(self, ip_val):
+        idx = bisect_right(self.starts, ip_val) - 1
+        return idx >= 0 and self.ends[idx] >= ip_val
 
-    start, end = get_ip_interval(p_str, mask)
-    action_deny = (rule.get('action', 'permit') == 'deny')
-    match_cond = And(ip_var >= start, ip_var <= end)
 
-    # Recursive construction of nested If-Then-Else logic
-    return If(match_cond, BoolVal(action_deny), build_acl_logic(ip_var, rules[1:]))
+def build_acl_logic(ip_var, deny_intervals):
+    # Membership in sorted disjoint deny intervals: a flat disjunction for small
+    # sets, otherwise a balanced If-tree that discards half the intervals per comparison
+    if not deny_intervals: return BoolVal(False)
+    if len(deny_intervals) <= ACL_BST_THRESHOLD:
+        return Or(*[ip_in_range(ip_var, start, end) for start, end in deny_intervals])
+
+    def bst(lo, hi):
+        if hi - lo == 1:
+            start, end = deny_intervals[lo]
+            return ip_in_range(ip_var, start, end)
+        mid = (lo + hi) // 2
+        return If(ip_below(ip_var, deny_intervals[mid][0]), bst(lo, mid), bst(mid, hi))
+
+    return bst(0, len(deny_intervals))
 
 
 # ==========================================
@@ -68,190 +264,221 @@ def load_base_constraints(topo_file, config_file):
     with open(config_file, 'r') as f:
         conf = json.load(f)
 
-    solver = Solver()
-    r_map = {}
-    all_routers = []
+    # No solver is built here: the RecAddDefinition-based theory below is stored in
+    # the Z3 context, so every solver created later in that context already sees it
 
-    # 1. Topology Nodes
+    # 1. Topology Nodes & VPN RT Configurations, in a single pass over the nodes
+    # joined against the intents. Router ids are interned: they are reused as keys
+    # of every per-router dict and of the (src, dst) template lookups.
+    intents = {sys.intern(intent['pe_id']): intent for intent in conf['vpn_network_intents']}
+    node_ids = []
+    all_rt_strs = set()
+    acl_db = {}  # Store effective ACL deny intervals (AclIntervalTree) in Python dict
+    export_set, import_set = {}, {}  # Per-PE RT sets for Python-side overlap checks
+
+    acl_rules = {}
     for node in topo['nodes']:
-        nid = node['id']
-        const = Const(nid, RouterSort)
-        r_map[nid] = const
-        all_routers.append(const)
-    solver.add(Distinct(all_routers))
-
-    # 2. Neighbor Relationships
-    true_pairs = set()
+        nid = sys.intern(node['id'])
+        node_ids.append(nid)
+        intent = intents.get(nid)
+        if intent is None:
+            acl_rules[nid] = []  # No ACLs for nodes without config
+            continue
+        export_set[nid] = set(intent.get('export_rt', []))
+        import_set[nid] = set(intent.get('import_rt', []))
+        all_rt_strs |= export_set[nid]
+        all_rt_strs |= import_set[nid]
+        raw_filters = intent.get('import_route_filters', [])
+        acl_rules[nid] = sorted(raw_filters, key=lambda x: x.get('index', 0))
+
+    # Store ACLs (parsed once here in a single batch, reused by every query)
+    parsed = parse_acl_rules_batch(list(acl_rules.values()))
+    for nid, triples in zip(acl_rules, parsed):
+        acl_db[nid] = AclIntervalTree(merge_intervals(compute_effective_deny_intervals(triples)))
+
+    # 2. Enumerated Router / RT sorts
+    theory = VpnTheory(node_ids, sorted(all_rt_strs))
+    r_map, rt_z3_map = theory.r_map, theory.rt_z3_map  # Local aliases for the definitions below
+
+    # 3. Neighbor Relationships (sparse: only the configured sessions, O(|edges|))
+    ibgp_pairs = set()  # (src_id, dst_id) in both directions, for Python-side filtering
     if 'ibgp_pe_mesh' in topo.get('bgp_sessions', {}):
         for s in topo['bgp_sessions']['ibgp_pe_mesh']:
-            n1, n2 = s['nodes']
+            n1, n2 = map(sys.intern, s['nodes'])
             if n1 in r_map and n2 in r_map:
-                u, v = r_map[n1], r_map[n2]
-                true_pairs.add((u, v));
-                true_pairs.add((v, u))
+                ibgp_pairs.add((n1, n2));
+                ibgp_pairs.add((n2, n1))
 
-    for r1 in all_routers:
-        for r2 in all_routers:
-            cond = (r1, r2) in true_pairs
-            solver.add(Ibgp_Neighbor(r1, r2) == cond)
+    x, y = Consts('x y', theory.router_sort)
+    define_pair_predicate(theory.ibgp_neighbor, x, y, [(r_map[u], r_map[v]) for u, v in sorted(ibgp_pairs)])
 
-    # 3. VPN RT Configurations
-    all_rt_strs = set()
-    pe_conf_map = {}
-    acl_db = {}  # Store raw ACL rules in Python dict
-
-    for intent in conf['vpn_network_intents']:
-        pe_id = intent['pe_id']
-        pe_conf_map[pe_id] = intent
-        for rt in intent.get('export_rt', []): all_rt_strs.add(rt)
-        for rt in intent.get('import_rt', []): all_rt_strs.add(rt)
-        # Store ACLs
-        raw_filters = intent.get('import_route_filters', [])
-        acl_db[pe_id] = sorted(raw_filters, key=lambda x: x.get('index', 0))
-
-    rt_z3_map = {s: Const(f"rt_{s.replace(':', '_')}", RTSort) for s in all_rt_strs}
-    if rt_z3_map: solver.add(Distinct(list(rt_z3_map.values())))
-
-    for nid, r_const in r_map.items():
-        if nid in pe_conf_map:
-            c = pe_conf_map[nid]
-            my_im = set(c.get('import_rt', []))
-            my_ex = set(c.get('export_rt', []))
-            for rt_str, rt_const in rt_z3_map.items():
-                solver.add(Has_Import_RT(r_const, rt_const) == (rt_str in my_im))
-                solver.add(Has_Export_RT(r_const, rt_const) == (rt_str in my_ex))
-        else:
-            acl_db[nid] = []  # No ACLs for nodes without config
-            for rt_const in rt_z3_map.values():
-                solver.add(Has_Import_RT(r_const, rt_const) == False)
-                solver.add(Has_Export_RT(r_const, rt_const) == False)
+    # 4. RT Predicates: only configured (router, RT) pairs are enumerated, every
+    # other pair (incl. non-PE nodes) is False by definition
+    import_pairs = [(r_map[nid], rt_z3_map[rt]) for nid, rts in import_set.items() for rt in sorted(rts)]
+    export_pairs = [(r_map[nid], rt_z3_map[rt]) for nid, rts in export_set.items() for rt in sorted(rts)]
+    r_var, rt_var = Const('r', theory.router_sort), Const('rt', theory.rt_sort)
+    define_pair_predicate(theory.has_import_rt, r_var, rt_var, import_pairs)
+    define_pair_predicate(theory.has_export_rt, r_var, rt_var, export_pairs)
 
-    return solver, r_map, rt_z3_map, acl_db
+    return theory, acl_db, export_set, import_set, ibgp_pairs
 
 
 # ==========================================
 # Mode A: Monolithic Verification
 # ==========================================
-def run_monolithic_benchmark(base_solver, r_map, rt_map, acl_db):
+def run_monolithic_benchmark(theory, acl_db):
+    r_map = theory.r_map
     print("\n" + "=" * 60)
     print("   [Mode A] Monolithic Encoding (Full ACL Injection)")
     print("=" * 60)
 
-    # Deep copy solver to avoid side effects
-    s = base_solver.translate(base_solver.ctx)
-    rt_val = Const('rt_val', RTSort)
-    target_ip_var = Int('target_ip_var')
-    s.add(target_ip_var >= 0, target_ip_var <= 4294967295)
-
-    # --- 1. Inject ALL ACLs into Solver (Bottleneck!) ---
-    t_start_inject = time.time()
-
-    sym_ip = Const('sym_ip', IPSort)
-
-    # Iterate all routers, burn ACL logic into global predicate Is_Prefix_Denied_Global
-    count = 0
-    for nid, rules in acl_db.items():
-        r_const = r_map[nid]
-        # Build logic tree
-        acl_expr = build_acl_logic(sym_ip, rules)
-        # Add Quantified Constraint (ForAll)
-        s.add(ForAll([sym_ip], Is_Prefix_Denied_Global(r_const, sym_ip) == acl_expr))
-        count += len(rules)
-
-    t_end_inject = time.time()
-    print(f"ACL Injection Time: {t_end_inject - t_start_inject:.4f} s (Total Rules: {count})")
-    print(f"Current Constraint Count: {len(s.assertions())}")
-
-    # --- 2. Execute Queries ---
-    def check_mono(src_id, dst_id, ip_str):
-        print(f"  Check {src_id}->{dst_id} IP={ip_str} ... ", end="", flush=True)
-        s.push()
-        src, dst = r_map[src_id], r_map[dst_id]
-        ip_val = ip_str_to_int(ip_str)
-
-        # Constraint: Target specific IP
-        s.add(target_ip_var == ip_val)
-
-        # Axiom: Call global predicate
-        can_propagate = And(
-            Ibgp_Neighbor(src, dst),
-            Has_Export_RT(src, rt_val),
-            Has_Import_RT(dst, rt_val),
-            Not(Is_Prefix_Denied_Global(dst, target_ip_var))  # Global Call
-        )
-        s.add(can_propagate)
-
-        t0 = time.time()
-        res = s.check()
-        dt = (time.time() - t0) * 1000
-        print(f"{res} ({dt:.2f} ms)")
-        s.pop()
-        return dt
-
-    total_time = 0
-    if "PE1" in r_map and "PE2" in r_map:
-        total_time += check_mono("PE1", "PE2", "192.168.1.1")  # Permit
-        total_time += check_mono("PE2", "PE1", "10.0.1.100")   # Deny
-        total_time += check_mono("PE2", "PE1", "10.0.99.1")    # Permit
-
-    return total_time
+    # Global Z3 parameters: enabled for this benchmark only, restored on exit
+    parallel_params = {}
+    if MONO_PARALLEL:
+        parallel_params = {'parallel.enable': True, 'parallel.threads.max': os.cpu_count()}
+
+    with scoped_z3_params(parallel_params):
+        # Fresh solver: the VPN theory lives in the context, so there are no base
+        # assertions to copy (no translate() deep copy either)
+        s = Solver()
+        rt_val = Const('rt_val', theory.rt_sort)
+        target_ip_var = declare_ip_var(s, 'target_ip_var')
+
+        # --- 1. Inject ALL ACLs into Solver (Bottleneck!) ---
+        t_start_inject = time.time()
+
+        # Iterate all routers, burn ACL logic into one quantifier-free definition per router.
+        # The deny disjunction is grounded on the shared target_ip_var, so no ForAll
+        # (and no E-matching / MBQI) is needed to reuse it across queries.
+        is_denied = {}
+        count = 0
+        for nid, acl in acl_db.items():
+            # Build deny disjunction
+            acl_expr = build_acl_logic(target_ip_var, acl.intervals)
+            # Add Quantifier-Free Definition (macro)
+            is_denied[nid] = Bool(f"is_denied_{nid}")
+            s.add(is_denied[nid] == acl_expr)
+            count += len(acl)
+
+        t_end_inject = time.time()
+        print(f"ACL Injection Time: {t_end_inject - t_start_inject:.4f} s (Total Deny Intervals: {count})")
+        print(f"Current Constraint Count: {len(s.assertions())}")
+
+        # --- 2. Execute Queries ---
+        # Freeze the injected solver as an immutable base and clone it per query, so
+        # each check runs on a fresh (non-incremental) solver instead of push/pop
+        s_injected = s
+
+        def check_mono(src_id, dst_id, ip_str):
+            print(f"  Check {src_id}->{dst_id} IP={ip_str} ... ", end="", flush=True)
+            src, dst = r_map[src_id], r_map[dst_id]
+            ip_val = ip_str_to_int(ip_str)
+
+            # Timed from the clone on: the copy is part of the per-query cost
+            t0 = time.time()
+            s2 = Solver()
+            s2.add(s_injected.assertions())
+
+            # Constraint: Target specific IP
+            s2.add(target_ip_var == ip_val)
+
+            # Axiom: Reference injected per-router definition
+            can_propagate = And(
+                theory.ibgp_neighbor(src, dst),
+                theory.has_export_rt(src, rt_val),
+                theory.has_import_rt(dst, rt_val),
+                Not(is_denied[dst_id])  # Injected Definition
+            )
+            s2.add(can_propagate)
+
+            res = s2.check()
+            dt = (time.time() - t0) * 1000
+            print(f"{res} ({dt:.2f} ms)")
+            return dt
+
+        total_time = 0
+        if "PE1" in r_map and "PE2" in r_map:
+            total_time += check_mono("PE1", "PE2", "192.168.1.1")  # Permit
+            total_time += check_mono("PE2", "PE1", "10.0.1.100")   # Deny
+            total_time += check_mono("PE2", "PE1", "10.0.99.1")    # Permit
+
+        return total_time
 
 
 # ==========================================
 # Mode B: Hybrid/On-Demand Verification
 # ==========================================
-def run_hybrid_benchmark(base_solver, r_map, rt_map, acl_db):
+def run_hybrid_benchmark(theory, acl_db, export_set, import_set, ibgp_pairs):
+    r_map = theory.r_map
     print("\n" + "=" * 60)
     print("   [Mode B] Hybrid/On-Demand Encoding (Lazy Injection)")
     print("=" * 60)
 
-    s = base_solver.translate(base_solver.ctx)
-    rt_val = Const('rt_val', RTSort)
-    target_ip_var = Int('target_ip_var')
-    s.add(target_ip_var >= 0, target_ip_var <= 4294967295)
+    # Logic-specific solver instead of the default combined-theory pipeline
+    # (the VPN theory lives in the context, nothing to copy in)
+    s = SolverFor(HYBRID_LOGIC)
 
     # Note: No global ACL injection here!
     print("Skipping global ACL injection...")
 
+    # The queried IP is always concrete, so the ACL is evaluated in Python
+    # (AclIntervalTree lookup on the sorted deny intervals). The RT existential over rt_val is a
+    # set intersection of the per-PE RT sets, also decided in Python. What remains
+    # is the ground Ibgp_Neighbor(src, dst): precompile templates of it for the iBGP
+    # sessions only (O(|edges|), not every router pair), so queries only select an
+    # existing AST. Pairs without a session are filtered out before reaching Z3.
+    t_start_compile = time.time()
+    templates = {
+        (sid, did): And(
+            theory.ibgp_neighbor(r_map[sid], r_map[did]),
+            BoolVal(has_rt_overlap(export_set, import_set, sid, did))
+        )
+        for sid, did in ibgp_pairs
+    }
+    print(f"Template Compile Time: {time.time() - t_start_compile:.4f} s (Templates: {len(templates)})")
+
     # --- Execute Queries ---
-    def check_hybrid(src_id, dst_id, ip_str):
+    # All queries are loaded up front, each behind its own guard literal q_i.
+    # Every check(q_i) then runs on the same monotonic assertion set (no push/pop),
+    # reusing clauses learned by earlier queries. The session and ACL prefilters run
+    # inside check_hybrid's timed region; queries they reject never reach check().
+    queries = []
+    if "PE1" in r_map and "PE2" in r_map:
+        queries = [
+            ("PE2", "PE1", "192.168.1.1"),
+            ("PE2", "PE1", "10.0.10.100"),
+            ("PE2", "PE1", "10.0.99.1"),
+        ]
+
+    guards = []
+    for i, (src_id, dst_id, ip_str) in enumerate(queries):
+        g = Bool(f"q_{i}")
+        if (src_id, dst_id) in templates:
+            s.add(Implies(g, templates[(src_id, dst_id)]))
+        guards.append(g)
+
+    def check_hybrid(g, src_id, dst_id, ip_str):
         print(f"  Check {src_id}->{dst_id} IP={ip_str} ... ", end="", flush=True)
-        s.push()
-        src, dst = r_map[src_id], r_map[dst_id]
-        ip_val = ip_str_to_int(ip_str)
-        s.add(target_ip_var == ip_val)
-
-        # Key Difference: Dynamically generate local logic, avoid global predicates
-        rules = acl_db.get(dst_id, [])
-
-        if rules:
-            print(f"[Inject {len(rules)} ACLs] ... ", end="", flush=True)
-        else:
-            print(f"[No ACLs] ... ", end="", flush=True)
-
-        # is_denied_expr is a temporary expression tree
-        is_denied_expr = build_acl_logic(target_ip_var, rules)
-
-        can_propagate = And(
-            Ibgp_Neighbor(src, dst),
-            Has_Export_RT(src, rt_val),
-            Has_Import_RT(dst, rt_val),
-            Not(is_denied_expr)  # Embed logic tree directly
-        )
-        s.add(can_propagate)
 
+        # Timed from the prefilters on: the Python-side work is part of the per-query cost
         t0 = time.time()
-        res = s.check()
+        # Key Difference: session, ACL and RT overlap decided outside the solver
+        if (src_id, dst_id) not in templates:
+            print(f"[No iBGP Session] ... ", end="", flush=True)
+            res = unsat
+        elif acl_db[dst_id].is_denied(ip_str_to_int(ip_str)):
+            print(f"[ACL Deny] ... ", end="", flush=True)
+            res = unsat
+        else:
+            print(f"[ACL Permit] ... ", end="", flush=True)
+            res = s.check(g)
         dt = (time.time() - t0) * 1000
         print(f"{res} ({dt:.2f} ms)")
-        s.pop()
         return dt
 
     total_time = 0
-    if "PE1" in r_map and "PE2" in r_map:
-        total_time += check_hybrid("PE2", "PE1", "192.168.1.1")
-        total_time += check_hybrid("PE2", "PE1", "10.0.10.100")
-        total_time += check_hybrid("PE2", "PE1", "10.0.99.1")
+    for g, query in zip(guards, queries):
+        total_time += check_hybrid(g, *query)
 
     return total_time
 
@@ -265,13 +492,13 @@ if __name__ == "__main__":
 
     try:
         # 1. Prepare Base Environment (Topology + RT)
-        s_base, r_map, rt_map, acl_db = load_base_constraints(topo_file, config_file)
+        theory, acl_db, export_set, import_set, ibgp_pairs = load_base_constraints(topo_file, config_file)
 
         # 3. Run Hybrid Benchmark
-        t_hybrid = run_hybrid_benchmark(s_base, r_map, rt_map, acl_db)
+        t_hybrid = run_hybrid_benchmark(theory, acl_db, export_set, import_set, ibgp_pairs)
 
         # 2. Run Monolithic Benchmark
-        t_mono = run_monolithic_benchmark(s_base, r_map, rt_map, acl_db)
+        t_mono = run_monolithic_benchmark(theory, acl_db)
 
         # 4. Results Comparison
         print("\n" + "=" * 60)